@@ -1,11 +1,12 @@
 import os
 import glob
+import fnmatch
+from functools import lru_cache, reduce
 
-import livereload
-from flask import Flask, Config, Blueprint, render_template, request
+from flask import Flask, Config, Blueprint, render_template, send_from_directory
 from flask_assets import Environment, Bundle
 from webassets.filter import get_filter
-from jinja2 import nodes, ChoiceLoader, FileSystemLoader
+from jinja2 import nodes, FileSystemLoader, FileSystemBytecodeCache, TemplateNotFound
 from jinja2.ext import Extension
 
 import ea_utils as utils
@@ -27,8 +28,8 @@ ea_config = {
         "add_http",
         "add_https"
     ],
-    #: Add some parameters and functions to jinja context because
-    #: the functions behaves differently with each request
+    #: Functions added to jinja context, they behave differently with each request
+    #: by reading the current request when called
     'JINJA_CONTEXT': [
         "relative_years",
         "highlight_link",
@@ -52,6 +53,13 @@ ea_config = {
     'SCSS_FOLDERS': ['static/scss'],
     'TEMPLATES_FOLDERS': ['templates'],
 
+    #: Production mode, templates are not reloaded when changed
+    'PRODUCTION': True,
+
+    #: Folder for the compiled jinja templates, reused across restarts
+    #: None to disable it, e.g. on read-only deployments
+    'JINJA_CACHE_DIR': '.jinja_cache',
+
     #: Watch files for livereload
     'LIVERELOAD': [
         'static/scss/*.scss',
@@ -61,6 +69,35 @@ ea_config = {
 }
 
 
+def _resolve(names):
+    """
+    Look up the functions in ea_utils
+    :param names:   {name in jinja: function name in ea_utils}
+    :return:        {name in jinja: function}
+    """
+    missing = [v for v in names.values() if not hasattr(utils, v)]
+    if missing:
+        raise AttributeError('Functions not found in ea_utils: ' + ', '.join(missing))
+    return {k: getattr(utils, v) for k, v in names.items()}
+
+
+def _normalize_asset_groups(raw):
+    """
+    Make sure css, js and ext of every asset group are lists, a single file can be given as a string.
+    The config is left untouched, so app instances sharing the same config do not affect each other
+    :param raw:     asset groups from the config
+    :return:        copy of the asset groups with css, js and ext as lists
+    """
+    groups = {}
+    for k, v in raw.items():
+        group = dict(v)
+        for key in ('css', 'js', 'ext'):
+            if isinstance(group.get(key), str):
+                group[key] = [group[key]]
+        groups[k] = group
+    return groups
+
+
 class EnhancedApp(object):
     """
     Enhanced Flask App with additional jinja filters/function, webassets integration and livereload integration
@@ -70,6 +107,10 @@ class EnhancedApp(object):
         """
         
         """
+        # Paths are resolved against the current folder, which is the project of this app.
+        # Cached per instance, another app created after a chdir resolves its own paths
+        self._abs_path = lru_cache(maxsize=None)(utils.abs_path)
+
         config = Config('.', Flask.default_config)
         if config_file:
             config.from_object(config_file)
@@ -77,11 +118,21 @@ class EnhancedApp(object):
         self.app = Flask(app_name, **flask_kwargs)
         self.app.config = config
 
+        # Skip template mtime checks and never evict compiled templates in production.
+        # Must be set before jinja_env is first accessed, run_livereload turns auto_reload back on
+        if self.config.get('production', True):
+            self.app.jinja_options = dict(self.app.jinja_options, auto_reload=False, cache_size=-1)
+
         # Create webassets
         self.assets_env = Environment(self.app)
         self.assets_env.url_expire = True
         self.assets_env.url = '/static'
 
+        # Resolve the jinja filters/functions up front, so a typo in the config fails at startup
+        self._filters = _resolve(self.config['jinja_filters'])
+        self._funcs = _resolve(self.config['jinja_functions'])
+        self._ctx = _resolve(self.config['jinja_context'])
+
         # Initialize additional jinja stuff
         self.enhance_jinja(self.app.jinja_env)
 
@@ -90,6 +141,8 @@ class EnhancedApp(object):
         self.css_filters = []
         self.depends_scss = []
 
+        self._file_index = self._build_file_index(
+            self.config['js_folders'] + self.config['scss_folders'])
         self.enhance_assets()
 
     def create_folder_structure(self):
@@ -103,27 +156,27 @@ class EnhancedApp(object):
         # Activate HTML blocks trimming. Make the HTML look neater
         env.trim_blocks = True
         env.lstrip_blocks = True
+        # Persist compiled templates so they are not re-parsed on every start
+        cache_dir = self.config.get('jinja_cache_dir', '.jinja_cache')
+        if cache_dir:
+            cache_dir = self._abs_path(cache_dir)
+            os.makedirs(cache_dir, exist_ok=True)
+            env.bytecode_cache = FileSystemBytecodeCache(directory=cache_dir)
         # Add custom tags/blocks
         env.add_extension('ea.RequiredVariablesExtension')
 
         # Add additional jinja filters
-        for k, v in self.config['jinja_filters'].items():
-            env.filters[k] = getattr(utils, v)
-
-        for k, v in self.config['jinja_functions'].items():
-            env.globals[k] = getattr(utils, v)
+        env.filters.update(self._filters)
+        env.globals.update(self._funcs)
 
         # Initialize jinja context
-        @self.app.context_processor
-        def gen_jinja_context():
-            obj = {}
-            for _k, _v in self.config['jinja_context'].items():
-                obj[_k] = getattr(utils, _v)
-            return obj
+        # The functions read the request themselves when called, so they can
+        # live in the globals instead of a per request context processor
+        env.globals.update(self._ctx)
 
         # Add additional path for templates
-        self.app.jinja_loader = ChoiceLoader(
-            [FileSystemLoader(f) for f in self.config['templates_folders']])
+        # A single loader searches all the folders in order, no need to chain one loader per folder
+        self.app.jinja_loader = FileSystemLoader(self.config['templates_folders'])
 
     def enhance_assets(self):
         """
@@ -141,8 +194,11 @@ class EnhancedApp(object):
                 'babel', presets=self.config['babel_presets']))
 
         scss_includes = []
-        scss_depends = [utils.abs_path(os.path.join(
-            folder, '*.scss')) for folder in self.config['scss_folders']]
+        # webassets does not expand glob patterns in depends,
+        # a pattern cannot be stat'ed and forces a rebuild on every check.
+        # Resolve them into the scss files instead
+        scss_depends = self._glob_scss_depends()
+        self._scss_bundles = []
 
         for f in self.config['scss_libs']:
             scss_includes.append(self._find_file(
@@ -162,31 +218,48 @@ class EnhancedApp(object):
 
         #: CSS assets
         for folder in self.config['scss_folders']:
-            for f in os.listdir(folder):
-                if f.endswith('scss') and not f.startswith('_'):
-                    self.add_css_asset(f, folder, scss_filters, scss_depends)
-
-        asset_groups = self.config['asset_groups']
-        for k, v in asset_groups.items():
-            css = v.get('css', [])
-            if isinstance(css, basestring):
-                asset_groups[k]['css'] = [css]
-            js = v.get('js', [])
-            if isinstance(js, basestring):
-                asset_groups[k]['js'] = [js]
-            ext = v.get('ext', [])
-            if isinstance(ext, basestring):
-                asset_groups[k]['ext'] = [ext]
-        self.app.jinja_env.globals['asset_groups'] = asset_groups
+            with os.scandir(folder) as it:
+                for entry in it:
+                    name = entry.name
+                    # Partials starting with _ are only included by other scss files
+                    if name[:1] != '_' and name.endswith('.scss'):
+                        self._scss_bundles.append(
+                            self.add_css_asset(name, folder, scss_filters, scss_depends))
+
+        self.app.jinja_env.globals['asset_groups'] = _normalize_asset_groups(self.config['asset_groups'])
+
+    def precompile_assets(self):
+        """
+        Build all the registered bundles up front, so the first requests do not pay for it.
+        The bundles are built one by one, the css bundles share the same filter instances
+        :return:
+        """
+        with self.app.app_context():
+            for bundle in self.assets_env:
+                bundle.build()
 
     def add_js_asset(self, asset, filters):
         name, input_files = asset
-        if isinstance(input_files, basestring):
+        if isinstance(input_files, str):
             input_files = [input_files]
         files = []
         for f in input_files:
             if f.find('*') > -1:
-                files.extend(sorted(glob.glob(f), reverse=True))
+                folder, pattern = os.path.split(f)
+                if folder and folder.find('*') == -1:
+                    # Wildcard only in the filename, a single directory scan is enough
+                    # Like glob, hidden files only match a pattern starting with .
+                    # and a missing folder matches nothing
+                    skip_hidden = not pattern.startswith('.')
+                    matches = []
+                    if os.path.isdir(folder):
+                        with os.scandir(folder) as it:
+                            matches = [e.path for e in it
+                                       if not (skip_hidden and e.name.startswith('.'))
+                                       and e.is_file() and fnmatch.fnmatch(e.name, pattern)]
+                else:
+                    matches = glob.iglob(f)
+                files.extend(sorted(matches, reverse=True))
                 continue
             files.append(self._find_file(f, self.config['js_folders']))
         output_file = 'js/%s.js' % name
@@ -195,12 +268,28 @@ class EnhancedApp(object):
 
     def add_css_asset(self, filename, folder, filters, depends):
         name = filename[:-5]
-        input_file = utils.abs_path(os.path.join(folder, filename))
+        input_file = self._abs_path(os.path.join(folder, filename))
 
         output_file = 'css/%s.css' % name
         b = Bundle(input_file, output=output_file,
                    filters=filters, depends=depends)
         self.assets_env.register(name + '.css', b)
+        return b
+
+    def _glob_scss_depends(self):
+        depends = []
+        for folder in self.config['scss_folders']:
+            depends.extend(sorted(glob.glob(self._abs_path(os.path.join(folder, '*.scss')))))
+        return depends
+
+    def _refresh_scss_depends(self):
+        """
+        Pick up scss partials created after startup, e.g. while livereload is running
+        """
+        depends = self._glob_scss_depends()
+        for bundle in self._scss_bundles:
+            # Setting depends also clears the depends resolved by webassets
+            bundle.depends = depends
 
     def run_livereload(self, port=8080):
         """
@@ -208,52 +297,125 @@ class EnhancedApp(object):
         :param additional_files:    list of file patterns, relative to the project's root
         :return:
         """
+        # Imported here so production workers do not load livereload and tornado
+        import livereload
+
         self.app.debug = True
         self.app.jinja_env.globals['livereload'] = True
         self.app.jinja_env.auto_reload = True
         self.create_folder_structure()
         server = livereload.Server(self.app.wsgi_app)
+        # livereload expands the glob patterns itself, including recursive ** patterns
         for f in self.config['livereload_watch_files']:
-            server.watch(utils.abs_path(f % self.config))
+            server.watch(self._abs_path(f % self.config), self._refresh_scss_depends)
         server.serve(port=port, host='0.0.0.0')
 
     def add_error_handlers(self):
+        # Error templates resolved on first use, {template name: Template or None if missing}
+        self._error_templates = {}
+
         @self.app.errorhandler(410)
         def content_gone(e):
-            return render_template('410.html', error=e), 410
+            return self._render_error('410.html', e, 410)
 
         @self.app.errorhandler(403)
         def access_denied(e):
-            return render_template('403.html', error=e), 403
+            return self._render_error('403.html', e, 403)
 
         @self.app.errorhandler(404)
         def content_not_found(e):
-            if request.path == '/favicon.ico':
-                return 'Not found', 404
-            return render_template('404.html', error=e), 404
+            return self._render_error('404.html', e, 404)
 
-    def _create_path(self, path):
-        if os.path.exists(path):
+        # Browsers keep asking for a favicon, answer it from the router
+        # instead of going through the 404 handler.
+        # Skipped if the app already has a favicon view, a project's own
+        # /favicon.ico view must be registered before calling add_error_handlers
+        if any(rule.rule == '/favicon.ico' for rule in self.app.url_map.iter_rules()):
             return
-        parent = os.path.abspath(os.path.join(path, os.pardir))
-        while not os.path.exists(parent):
-            self._create_path(parent)
+
+        @self.app.route('/favicon.ico', endpoint='ea_favicon')
+        def favicon():
+            static_folder = self.app.static_folder
+            if static_folder and os.path.isfile(os.path.join(static_folder, 'favicon.ico')):
+                return send_from_directory(static_folder, 'favicon.ico')
+            return 'Not found', 404
+
+    def _render_error(self, template_name, error, code):
+        """
+        Render the error page of the project.
+        Without auto_reload the template is resolved once and reused, instead of walking
+        the template loaders on every error response. render_template accepts a Template object
+        and still applies the context processors
+        :param template_name:   e.g. 404.html
+        :param error:           the HTTPException
+        :param code:            HTTP status code
+        :return:                the rendered page, or werkzeug's default error page
+                                if the project does not have the template
+        """
+        env = self.app.jinja_env
+        if env.auto_reload:
+            template = template_name
+        else:
+            if template_name not in self._error_templates:
+                try:
+                    self._error_templates[template_name] = env.get_template(template_name)
+                except TemplateNotFound:
+                    self._error_templates[template_name] = None
+            template = self._error_templates[template_name]
+            if template is None:
+                return error
+        try:
+            return render_template(template, error=error), code
+        except TemplateNotFound as e:
+            if e.name != template_name:
+                raise
+            return error
+
+    def _create_path(self, path):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
         # Check if the path is a file
         if path.rfind('.') > path.rfind(os.path.sep):
-            open(path, 'w').close()
+            open(path, 'a').close()
         else:
-            os.mkdir(path)
+            os.makedirs(path, exist_ok=True)
 
     def _to_static_path(self, *filenames):
-        return os.path.join(utils.abs_path('static'), *filenames)
+        return os.path.join(self._abs_path('static'), *filenames)
+
+    def _build_file_index(self, folders):
+        """
+        Scan the asset folders once, so looking up a file does not need to stat every candidate path
+        :param folders:     folders to be indexed
+        :return:            {folder: {filename: absolute path}}
+        """
+        index = {}
+        for folder in folders:
+            if folder in index or not os.path.isdir(folder):
+                continue
+            with os.scandir(folder) as it:
+                index[folder] = {e.name: self._abs_path(e.path) for e in it if e.is_file()}
+        return index
 
     def _find_file(self, filename, paths):
+        for p in paths:
+            found = self._file_index.get(p, {}).get(filename)
+            if found:
+                return found
+        return self._slow_find_file(filename, paths)
+
+    def _slow_find_file(self, filename, paths):
         for p in [os.path.join(_p, filename) for _p in paths] + [filename]:
             if os.path.exists(p):
-                return utils.abs_path(p)
+                return self._abs_path(p)
         raise Exception('File not found:' + filename)
 
 
+#: End tag of the `required` block
+_REQUIRED_END = ('name:endrequired',)
+
+
 class RequiredVariablesExtension(Extension):
     # a set of names that trigger the extension.
     tags = set(['required'])
@@ -277,18 +439,19 @@ class RequiredVariablesExtension(Extension):
         with_node.targets = targets
         with_node.values = values
         with_node.body = parser.parse_statements(
-            ('name:endrequired',), drop_needle=True)
+            _REQUIRED_END, drop_needle=True)
 
         # Manually create a If node
         if_node = nodes.If()
-        # If only one variable is required, assigned that variable to test if it is empty
-        if len(values) == 1:
+        if not values:
+            # Nothing is required, always render the body
+            test = nodes.Const(True)
+        elif len(values) == 1:
+            # If only one variable is required, assigned that variable to test if it is empty
             test = values[0]
         else:
             # If more than one variables are required, concat them into a And node
-            test = nodes.And(left=values[0], right=values[1])
-            for i in range(2, len(values)):
-                test = nodes.And(left=test, right=values[i])
+            test = reduce(nodes.And, values)
 
         if_node.test = test
         # else_ attribute cannot be None
@@ -51,7 +51,7 @@ def random_string(l=16):
     """Generate a random string of length l
     Code copied from StackOverflow, looks a bit confusing but works well
     """
-    return ''.join(random.SystemRandom().choice(string.uppercase + string.lowercase + string.digits) for _ in xrange(l))
+    return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(l))
 
 
 def gen_slug(input_string, existing_slugs=[], delimiter='-'):
@@ -188,7 +188,7 @@ def add_p(text):
     :param text: input text
     :return: html text with <p> tags surrounding each block
     """
-    if not isinstance(text, basestring):
+    if not isinstance(text, str):
         return ''
     arr = re.split('\n+', text)
     return '\n'.join(['<p>' + line + '</p>' for line in arr if len(line) > 0])
@@ -0,0 +1,24 @@
+from jinja2 import Environment
+
+from ea import RequiredVariablesExtension
+
+
+def render(source, **context):
+    env = Environment(extensions=[RequiredVariablesExtension])
+    return env.from_string(source).render(**context)
+
+
+def test_required_without_variables():
+    assert render('{% required %}body{% endrequired %}') == 'body'
+
+
+def test_required_one_variable():
+    source = '{% required name=user %}{{ name }}{% endrequired %}'
+    assert render(source, user='ea') == 'ea'
+    assert render(source, user='') == ''
+
+
+def test_required_multiple_variables():
+    source = '{% required a=x, b=y, c=z %}{{ a }}{{ b }}{{ c }}{% endrequired %}'
+    assert render(source, x=1, y=2, z=3) == '123'
+    assert render(source, x=1, y=0, z=3) == ''